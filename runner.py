@@ -1,10 +1,20 @@
-import io, os, time, tempfile, requests, sys
-from PIL import Image
+import io, os, re, time, math, bisect, shutil, threading, multiprocessing, requests, sys
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import fitz  # PyMuPDF
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload, MediaIoBaseDownload
+import pikepdf
+try:
+    import mozjpeg_lossless_optimization  # optional, see USE_MOZJPEG
+except ImportError:
+    mozjpeg_lossless_optimization = None
+try:
+    import numpy as np
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJSAMP_420  # optional, see USE_TURBOJPEG
+except ImportError:
+    TurboJPEG = None
+# Google API libraries are imported lazily inside the functions that use them,
+# so spawned render workers (which only need fitz/pikepdf) never load them.
 
 # ===================================================================
 # CONFIG
@@ -42,12 +52,44 @@ START_DPI, MIN_DPI = 150, 72
 START_JPEG_QUALITY, MIN_JPEG_QUALITY = 85, 30
 DPI_STEP, QUALITY_STEP = 10, 5
 
+# re-pack page JPEGs with mozjpeg (progressive + optimized Huffman, lossless)
+USE_MOZJPEG = os.environ.get("USE_MOZJPEG", "").strip() == "1"
+
+# encode pages with libjpeg-turbo (SIMD) instead of MuPDF's bundled libjpeg
+USE_TURBOJPEG = os.environ.get("USE_TURBOJPEG", "").strip() == "1"
+
+# approximate JPEG size vs quality at a fixed resolution (relative, monotone)
+JPEG_QUALITY_SIZE = [
+    (30, 0.34), (35, 0.37), (40, 0.40), (45, 0.44), (50, 0.47), (55, 0.51),
+    (60, 0.56), (65, 0.61), (70, 0.67), (75, 0.74), (80, 0.84), (85, 1.00),
+]
+PREDICT_MARGIN = 0.92   # aim a bit under the limit so one prediction usually fits
+
 DOWNLOAD_TIMEOUT, MAX_ROWS_TO_CHECK = 60, 10000
+RESUMABLE_UPLOAD_BYTES = 5 * 1024 * 1024
+
+FLUSH_EVERY_ROWS = 25   # batch Sheets writes every N processed rows
+MAX_WORKERS = int(os.environ.get("MAX_WORKERS", "8"))   # rows downloading/uploading in parallel
+CPU_WORKERS = int(os.environ.get("CPU_WORKERS", str(min(os.cpu_count() or 1, 4))))  # render processes
 
 # ===================================================================
 # AUTH
 # ===================================================================
-def get_clients():
+_thread_state = threading.local()
+
+# shared keep-alive pool for plain HTTP downloads (urllib3 pools are thread-safe)
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(
+    pool_connections=16, pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+)
+_SESSION.mount("https://", _ADAPTER)
+_SESSION.mount("http://", _ADAPTER)
+
+def get_credentials():
+    from google.oauth2.credentials import Credentials
+    from google.auth.transport.requests import Request
+
     required = ["GOOGLE_OAUTH_REFRESH_TOKEN", "GOOGLE_OAUTH_CLIENT_ID", "GOOGLE_OAUTH_CLIENT_SECRET"]
     missing = [k for k in required if not os.environ.get(k)]
     if missing:
@@ -62,215 +104,384 @@ def get_clients():
         scopes=SCOPES,
     )
     creds.refresh(Request())
-    drive = build("drive", "v3", credentials=creds, cache_discovery=False)
-    sheets = build("sheets", "v4", credentials=creds, cache_discovery=False)
-    return drive, sheets
+    return creds
+
+def get_clients(creds):
+    # httplib2 (used by googleapiclient) is not thread-safe: one client pair per thread
+    clients = getattr(_thread_state, "clients", None)
+    if clients is None:
+        from googleapiclient.discovery import build
+        drive = build("drive", "v3", credentials=creds, cache_discovery=False)
+        sheets = build("sheets", "v4", credentials=creds, cache_discovery=False)
+        clients = _thread_state.clients = (drive, sheets)
+    return clients
 
 # ===================================================================
 # HELPERS
 # ===================================================================
-def _col_letter(col_idx):
+def _col_letter_slow(col_idx):
     s = ""
     while col_idx > 0:
         col_idx, rem = divmod(col_idx - 1, 26)
         s = chr(65 + rem) + s
     return s
 
-def ensure_sheet_grid(sheets_svc, spreadsheet_id, sheet_name, min_cols=10, min_rows=2000):
+_COL_LETTERS = [""] + [_col_letter_slow(i) for i in range(1, 703)]   # A..ZZ
+
+def _col_letter(col_idx):
+    return _COL_LETTERS[col_idx] if 0 < col_idx < len(_COL_LETTERS) else _col_letter_slow(col_idx)
+
+def ensure_sheet_grids(sheets_svc, spreadsheet_id, min_cols_by_sheet, min_rows=2000):
+    # one metadata read + at most one batchUpdate for all sheets
     ss = sheets_svc.spreadsheets().get(spreadsheetId=spreadsheet_id, fields="sheets.properties").execute()
-    sheet = next((s["properties"] for s in ss["sheets"] if s["properties"]["title"] == sheet_name), None)
-    if not sheet:
-        raise RuntimeError(f"Sheet not found: {sheet_name}")
-    sheet_id = sheet["sheetId"]
-    gp = sheet.get("gridProperties", {})
+    props = {s["properties"]["title"]: s["properties"] for s in ss["sheets"]}
     reqs = []
-    if gp.get("columnCount", 0) < min_cols:
-        reqs.append({"updateSheetProperties": {
-            "properties": {"sheetId": sheet_id, "gridProperties": {"columnCount": min_cols}},
-            "fields": "gridProperties.columnCount"}})
-    if gp.get("rowCount", 0) < min_rows:
-        reqs.append({"updateSheetProperties": {
-            "properties": {"sheetId": sheet_id, "gridProperties": {"rowCount": min_rows}},
-            "fields": "gridProperties.rowCount"}})
+    for sheet_name, min_cols in min_cols_by_sheet.items():
+        sheet = props.get(sheet_name)
+        if not sheet:
+            raise RuntimeError(f"Sheet not found: {sheet_name}")
+        sheet_id = sheet["sheetId"]
+        gp = sheet.get("gridProperties", {})
+        if gp.get("columnCount", 0) < min_cols:
+            reqs.append({"updateSheetProperties": {
+                "properties": {"sheetId": sheet_id, "gridProperties": {"columnCount": min_cols}},
+                "fields": "gridProperties.columnCount"}})
+        if gp.get("rowCount", 0) < min_rows:
+            reqs.append({"updateSheetProperties": {
+                "properties": {"sheetId": sheet_id, "gridProperties": {"rowCount": min_rows}},
+                "fields": "gridProperties.rowCount"}})
     if reqs:
         sheets_svc.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body={"requests": reqs}).execute()
 
-def sheet_get_columns(sheets_svc, spreadsheet_id, sheet_name, cols_and_start):
-    result = {}
-    for col_idx, start_row in cols_and_start:
-        col_letter = _col_letter(col_idx)
-        rng = f"{sheet_name}!{col_letter}{start_row}:{col_letter}{MAX_ROWS_TO_CHECK}"
-        resp = sheets_svc.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=rng).execute()
-        vals = resp.get("values", [])
-        result[col_idx] = [(r[0].strip() if r and r[0] else "") for r in vals]
-    return result
-
-def sheet_update_cell(sheets_svc, spreadsheet_id, sheet_name, row, col, value):
-    rng = f"{sheet_name}!{_col_letter(col)}{row}"
-    sheets_svc.spreadsheets().values().update(
-        spreadsheetId=spreadsheet_id,
-        range=rng,
-        valueInputOption="RAW",
-        body={"range": rng, "values": [[value]]}
+def sheet_batch_get(sheets_svc, spreadsheet_id, ranges):
+    # COLUMNS: each single-column range comes back as one flat list instead of
+    # one nested list per row. Values stay formatted so invoice numbers keep
+    # their displayed form (leading zeros etc.).
+    resp = sheets_svc.spreadsheets().values().batchGet(
+        spreadsheetId=spreadsheet_id, ranges=ranges, majorDimension="COLUMNS"
     ).execute()
+    return resp.get("valueRanges", [])
 
-def get_existing_git_invoices(sheets_svc, spreadsheet_id, git_sheet):
-    rng = f"{git_sheet}!A2:A{MAX_ROWS_TO_CHECK}"
-    resp = sheets_svc.spreadsheets().values().get(
-        spreadsheetId=spreadsheet_id, range=rng
-    ).execute()
-    vals = resp.get("values", [])
-    return set(v[0].strip() for v in vals if v and v[0].strip())
+def column_range(sheet_name, col_idx, start_row):
+    col_letter = _col_letter(col_idx)
+    return f"{sheet_name}!{col_letter}{start_row}:{col_letter}{MAX_ROWS_TO_CHECK}"
+
+def column_values(value_range):
+    cols = value_range.get("values", [])
+    return [(v.strip() if v else "") for v in (cols[0] if cols else [])]
+
+def flush_rows(sheets_svc, spreadsheet_id, sheet_name, first_col, pending_rows, final=False):
+    # append (not a cached row cursor) so overlapping runs can't overwrite each other;
+    # a failed write keeps the buffer so the next flush retries it (caller checks after the final one)
+    if not pending_rows:
+        return
+    last_col = first_col + len(pending_rows[0]) - 1
+    try:
+        sheets_svc.spreadsheets().values().append(
+            spreadsheetId=spreadsheet_id,
+            range=f"{sheet_name}!{_col_letter(first_col)}:{_col_letter(last_col)}",
+            valueInputOption="RAW",
+            insertDataOption="INSERT_ROWS",
+            body={"values": pending_rows}
+        ).execute(num_retries=3)
+    except Exception as e:
+        retry = "" if final else ", will retry"
+        print(f"⚠️ Sheets write failed ({len(pending_rows)} pending){retry}:", e)
+        return
+    pending_rows.clear()
+
+_RE_FILE_D = re.compile(r"/file/d/([a-zA-Z0-9_-]{10,})")
+_RE_ID_QS = re.compile(r"[?&]id=([a-zA-Z0-9_-]{10,})")
+_BAD_FN_TABLE = str.maketrans({c: "_" for c in '\\/*?:"<>|'})
 
 def extract_drive_file_id(url):
-    import re
-    for pat in (r"/file/d/([a-zA-Z0-9_-]{10,})", r"[?&]id=([a-zA-Z0-9_-]{10,})"):
-        m = re.search(pat, url)
+    for pat in (_RE_FILE_D, _RE_ID_QS):
+        m = pat.search(url)
         if m:
             return m.group(1)
     return None
 
-def download_drive_file_by_id(drive_svc, file_id, out_path):
+def download_drive_file_by_id(drive_svc, file_id):
+    from googleapiclient.http import MediaIoBaseDownload
     request = drive_svc.files().get_media(fileId=file_id)
-    with io.FileIO(out_path, "wb") as fh:
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while not done:
-            _, done = downloader.next_chunk()
-    return os.path.getsize(out_path)
-
-def download_url_to_file(drive_svc, url, out_path, timeout=60):
+    bio = io.BytesIO()
+    downloader = MediaIoBaseDownload(bio, request)
+    done = False
+    while not done:
+        _, done = downloader.next_chunk()
+    return bio.getvalue()
+
+def download_url_to_bytes(drive_svc, url, timeout=60):
     if "drive.google.com" in url:
         fid = extract_drive_file_id(url)
         if fid:
             try:
-                return download_drive_file_by_id(drive_svc, fid, out_path)
+                return download_drive_file_by_id(drive_svc, fid)
             except Exception:
                 pass
-    r = requests.get(url, stream=True, timeout=timeout)
-    r.raise_for_status()
-    with open(out_path, "wb") as f:
-        for chunk in r.iter_content(1024 * 64):
-            if chunk:
-                f.write(chunk)
-    return os.path.getsize(out_path)
-
-def render_pages_to_images(input_pdf_path, dpi):
-    doc = fitz.open(input_pdf_path)
-    images = []
-    for p in range(len(doc)):
-        page = doc.load_page(p)
-        pix = page.get_pixmap(matrix=fitz.Matrix(dpi/72, dpi/72), alpha=False)
-        img = Image.open(io.BytesIO(pix.tobytes("png"))).convert("RGB")
-        images.append(img)
-    doc.close()
-    return images
-
-def compose_images_to_target_size(images, target_w_pt, target_h_pt, dpi, jpeg_quality):
-    target_w_px, target_h_px = int(target_w_pt * dpi / 72), int(target_h_pt * dpi / 72)
-    canvases = []
-    for img in images:
-        w, h = img.size
-        ratio = min(target_w_px / w, target_h_px / h)
-        new_w, new_h = int(w * ratio), int(h * ratio)
-        resized = img.resize((new_w, new_h), Image.LANCZOS)
-        canvas = Image.new("RGB", (target_w_px, target_h_px), (255, 255, 255))
-        canvas.paste(resized, ((target_w_px - new_w)//2, (target_h_px - new_h)//2))
-        canvases.append(canvas)
+    with _SESSION.get(url, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        bio = io.BytesIO()
+        shutil.copyfileobj(r.raw, bio, length=1024 * 1024)
+    return bio.getvalue()
+
+def open_pdf(pdf_bytes):
+    return fitz.open(stream=pdf_bytes, filetype="pdf")
+
+def _render_page(page, target_w_px, target_h_px):
+    # rasterize straight at the page's fitted size on the target page (no resize pass)
+    zoom = min(target_w_px / page.rect.width, target_h_px / page.rect.height)
+    return page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+
+def render_pages_to_pixmaps(doc, target_w_pt, target_h_pt, dpi):
+    target_w_px, target_h_px = target_w_pt * dpi / 72, target_h_pt * dpi / 72
+    return [_render_page(page, target_w_px, target_h_px) for page in doc]
+
+_turbojpeg = None
+
+def _get_turbojpeg():
+    # loads libturbojpeg once per process
+    global _turbojpeg
+    if _turbojpeg is None:
+        _turbojpeg = TurboJPEG()
+    return _turbojpeg
+
+def encode_pages_to_jpeg(pixmaps, jpeg_quality):
+    # raw samples go straight to JPEG (no PNG round-trip)
+    pages = []
+    for pix in pixmaps:
+        if USE_TURBOJPEG:
+            arr = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+            jpeg = _get_turbojpeg().encode(
+                arr, quality=jpeg_quality, pixel_format=TJPF_RGB, jpeg_subsample=TJSAMP_420
+            )
+        else:
+            jpeg = pix.tobytes("jpeg", jpg_quality=jpeg_quality)
+        if USE_MOZJPEG:
+            jpeg = mozjpeg_lossless_optimization.optimize(jpeg)
+        pages.append((jpeg, pix.width, pix.height))
+    return pages
+
+def compose_images_to_target_size(jpeg_pages, target_w_pt, target_h_pt):
+    # embed the JPEGs as /DCTDecode XObjects, centered on white pages (no re-encode)
+    pdf = pikepdf.Pdf.new()
+    contents_by_size = {}   # same-size pages share one placement stream
+    for jpeg, w, h in jpeg_pages:
+        image = pdf.make_stream(
+            b"",
+            Type=pikepdf.Name.XObject, Subtype=pikepdf.Name.Image,
+            ColorSpace=pikepdf.Name.DeviceRGB, BitsPerComponent=8, Width=w, Height=h,
+        )
+        image.write(jpeg, filter=pikepdf.Name.DCTDecode)
+
+        contents = contents_by_size.get((w, h))
+        if contents is None:
+            ratio = min(target_w_pt / w, target_h_pt / h)
+            draw_w, draw_h = w * ratio, h * ratio
+            x, y = (target_w_pt - draw_w) / 2, (target_h_pt - draw_h) / 2
+            contents = contents_by_size[(w, h)] = pdf.make_stream(
+                f"q {draw_w:.3f} 0 0 {draw_h:.3f} {x:.3f} {y:.3f} cm /Im0 Do Q".encode()
+            )
+
+        page = pdf.add_blank_page(page_size=(target_w_pt, target_h_pt))
+        page.Resources.XObject = pikepdf.Dictionary(Im0=image)
+        page.Contents = contents
 
     bio = io.BytesIO()
-    canvases[0].save(
-        bio,
-        format="PDF",
-        save_all=True,
-        append_images=canvases[1:],
-        quality=jpeg_quality,
-        optimize=True
-    )
-    bio.seek(0)
+    pdf.save(bio, linearize=False)
     return bio.getvalue()
 
 # ===================================================================
 # QUALITY-SAFE COMPRESSION (≤ 500 KB target)
 # ===================================================================
-def iterative_render_and_compress(path, w, h):
-    dpi, q = START_DPI, START_JPEG_QUALITY
-
-    while True:
-        images = render_pages_to_images(path, dpi)
-        pdf_bytes = compose_images_to_target_size(images, w, h, dpi, q)
-        size = len(pdf_bytes)
-
-        print(f"  try dpi={dpi} q={q} → {size} bytes")
-
-        # stop when under 500 KB
-        if size <= MAX_TARGET_BYTES:
-            return pdf_bytes, size, dpi, q
-
-        # reduce quality first (small steps)
-        if q - QUALITY_STEP >= MIN_JPEG_QUALITY:
-            q -= QUALITY_STEP
-
-        # then reduce DPI
-        elif dpi - DPI_STEP >= MIN_DPI:
-            dpi -= DPI_STEP
-            q = START_JPEG_QUALITY
+def _quality_size_factor(q):
+    qs = [tq for tq, _ in JPEG_QUALITY_SIZE]
+    i = min(bisect.bisect_left(qs, q), len(qs) - 1)
+    return JPEG_QUALITY_SIZE[i][1]
+
+def predict_dpi_and_quality(dpi, q, size):
+    # size ~ dpi² · f(q): shrink DPI first, solve for quality once DPI is floored
+    budget = MAX_TARGET_BYTES * PREDICT_MARGIN / size
+    new_dpi = int(dpi * math.sqrt(budget))
+    if new_dpi >= MIN_DPI:
+        return new_dpi, q
+
+    target_factor = _quality_size_factor(q) * budget * (dpi / MIN_DPI) ** 2
+    factors = [f for _, f in JPEG_QUALITY_SIZE]
+    i = bisect.bisect_right(factors, target_factor) - 1
+    return MIN_DPI, JPEG_QUALITY_SIZE[max(i, 0)][0]
+
+def _dpi_steps(dpi):
+    steps = list(range(dpi, MIN_DPI - 1, -DPI_STEP))
+    return steps if steps[-1] == MIN_DPI else steps + [MIN_DPI]
+
+def iterative_render_and_compress(src_bytes, w, h):
+    doc = open_pdf(src_bytes)   # parsed once, reused for every re-render
+    pixmaps, pixmaps_dpi = None, None
+
+    def attempt(dpi, q):
+        nonlocal pixmaps, pixmaps_dpi
+        # rasterize only when DPI changes; quality steps just re-encode
+        if dpi != pixmaps_dpi:
+            pixmaps, pixmaps_dpi = render_pages_to_pixmaps(doc, w, h, dpi), dpi
+        pdf_bytes = compose_images_to_target_size(encode_pages_to_jpeg(pixmaps, q), w, h)
+        print(f"  try dpi={dpi} q={q} → {len(pdf_bytes)} bytes")
+        return pdf_bytes, len(pdf_bytes), dpi, q
 
-        # last fallback (don't over-crush quality)
-        else:
-            return pdf_bytes, size, dpi, q
+    try:
+        # cheap lossless rewrite first (drops unused objects, deflates raw streams)
+        try:
+            lossless = doc.tobytes(garbage=3, deflate=True)
+        except Exception as e:
+            # damaged xref/streams can still rasterize fine
+            print("  lossless rewrite failed, rasterizing:", e)
+            lossless = None
+        if lossless is not None and len(lossless) <= MAX_TARGET_BYTES:
+            print(f"  lossless rewrite → {len(lossless)} bytes")
+            return lossless, len(lossless), None, None
+
+        result = attempt(START_DPI, START_JPEG_QUALITY)
+        if result[1] <= MAX_TARGET_BYTES:
+            return result
+
+        # jump straight to the predicted settings
+        dpi, q = predict_dpi_and_quality(START_DPI, START_JPEG_QUALITY, result[1])
+        result = attempt(dpi, q)
+        if result[1] <= MAX_TARGET_BYTES:
+            return result
+
+        # prediction overshot: size is monotone in quality, so bisect the
+        # quality grid at each DPI (highest DPI first) instead of stepping
+        q_hi = q - QUALITY_STEP
+        for d in _dpi_steps(dpi):
+            qualities = list(range(q_hi, MIN_JPEG_QUALITY - 1, -QUALITY_STEP))[::-1]
+            lo, hi, best = 0, len(qualities) - 1, None
+            while lo <= hi:
+                mid = (lo + hi) // 2
+                result = attempt(d, qualities[mid])
+                if result[1] <= MAX_TARGET_BYTES:
+                    best, lo = result, mid + 1
+                else:
+                    hi = mid - 1
+            if best:
+                return best
+            q_hi = START_JPEG_QUALITY
+
+        # last fallback (don't over-crush quality): smallest settings tried
+        return result
+    finally:
+        doc.close()
 
 def upload_file_to_drive_bytes(drive_svc, pdf_bytes, filename, folder_id):
-    media = MediaIoBaseUpload(io.BytesIO(pdf_bytes), mimetype="application/pdf", resumable=True)
+    from googleapiclient.http import MediaIoBaseUpload
+    # small files go up in a single multipart request (no resumable session round-trip)
+    media = MediaIoBaseUpload(
+        io.BytesIO(pdf_bytes), mimetype="application/pdf",
+        resumable=len(pdf_bytes) > RESUMABLE_UPLOAD_BYTES, chunksize=-1
+    )
     meta = {"name": filename}
     if folder_id:
         meta["parents"] = [folder_id]
-    f = drive_svc.files().create(body=meta, media_body=media, fields="id,size").execute()
+    f = drive_svc.files().create(
+        body=meta, media_body=media, fields="id,size", supportsAllDrives=True
+    ).execute()
     return f["id"], int(f.get("size", 0))
 
-def set_file_public_anyone(drive_svc, file_id):
-    try:
-        drive_svc.permissions().create(
+def set_files_public_anyone(drive_svc, file_ids):
+    # one batched HTTP call for all files; sharing stays best-effort
+    if not file_ids:
+        return
+    batch = drive_svc.new_batch_http_request(callback=lambda request_id, response, exception: None)
+    for file_id in file_ids:
+        batch.add(drive_svc.permissions().create(
             fileId=file_id,
-            body={"role": "reader", "type": "anyone"}
-        ).execute()
+            body={"role": "reader", "type": "anyone"},
+            supportsAllDrives=True
+        ))
+    try:
+        batch.execute()
     except Exception:
         pass
+    file_ids.clear()
 
 def safe_filename(s):
     s = (s or "").strip()
     if not s:
         return f"pdf_{int(time.time())}.pdf"
-    import re
-    s = re.sub(r'[\\/*?:"<>|]', "_", s)
+    s = s.translate(_BAD_FN_TABLE)
     return s if s.lower().endswith(".pdf") else s + ".pdf"
 
+# ===================================================================
+# PER-ROW PIPELINE
+# ===================================================================
+def start_cpu_pool():
+    # PyMuPDF is not thread-safe, so rendering runs in worker processes.
+    # spawn (not fork): workers start clean instead of inheriting the parent's
+    # threads, sockets and loaded API clients.
+    return ProcessPoolExecutor(max_workers=CPU_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+def process_row(creds, cpu_pool, url, inv, row_num):
+    print(f"Processing invoice {inv} from row {row_num}")
+    drive_svc, _ = get_clients(creds)
+
+    # download
+    src_bytes = download_url_to_bytes(drive_svc, url, timeout=DOWNLOAD_TIMEOUT)
+
+    # already within budget: upload the original untouched
+    if len(src_bytes) <= MAX_TARGET_BYTES and b"%PDF" in src_bytes[:1024]:
+        file_id, uploaded_size = upload_file_to_drive_bytes(
+            drive_svc, src_bytes, safe_filename(inv), DEST_FOLDER_ID
+        )
+        view_url = f"https://drive.google.com/uc?export=view&id={file_id}"
+        return file_id, view_url, f"PASSTHROUGH size={uploaded_size}"
+
+    # compress (CPU-bound, off the I/O thread)
+    pdf_bytes, final_size, used_dpi, used_quality = cpu_pool.submit(
+        iterative_render_and_compress, src_bytes, TARGET_WIDTH_PT, TARGET_HEIGHT_PT
+    ).result()
+    del src_bytes   # don't hold the source PDF in memory during the upload
+
+    # upload
+    filename = safe_filename(inv)
+    file_id, uploaded_size = upload_file_to_drive_bytes(
+        drive_svc, pdf_bytes, filename, DEST_FOLDER_ID
+    )
+
+    view_url = f"https://drive.google.com/uc?export=view&id={file_id}"
+    if used_dpi is None:
+        return file_id, view_url, f"LOSSLESS size={uploaded_size}"
+    flag = "COMPRESSED" if uploaded_size <= MAX_TARGET_BYTES else "LARGE_FILE"
+    return file_id, view_url, f"{flag} dpi={used_dpi} q={used_quality} size={uploaded_size}"
+
 # ===================================================================
 # MAIN
 # ===================================================================
 def main():
     if not SPREADSHEET_ID:
         raise RuntimeError("SPREADSHEET_ID missing")
+    if USE_MOZJPEG and mozjpeg_lossless_optimization is None:
+        raise RuntimeError("USE_MOZJPEG=1 requires mozjpeg-lossless-optimization")
+    if USE_TURBOJPEG and TurboJPEG is None:
+        raise RuntimeError("USE_TURBOJPEG=1 requires PyTurboJPEG and numpy")
 
-    drive_svc, sheets_svc = get_clients()
+    creds = get_credentials()
+    drive_svc, sheets_svc = get_clients(creds)
 
     # ensure sheets exist
-    ensure_sheet_grid(sheets_svc, SPREADSHEET_ID, SHEET_NAME, min_cols=10)
-    ensure_sheet_grid(sheets_svc, SPREADSHEET_ID, GIT_SHEET_NAME, min_cols=3)
-
-    # load existing GIT invoices
-    existing_git_invoices = get_existing_git_invoices(
-        sheets_svc, SPREADSHEET_ID, GIT_SHEET_NAME
-    )
+    ensure_sheet_grids(sheets_svc, SPREADSHEET_ID, {SHEET_NAME: 10, GIT_SHEET_NAME: 3})
+
+    # read source columns + GIT invoices in a single round-trip
+    invoices, urls, git_invoices = (column_values(vr) for vr in sheet_batch_get(
+        sheets_svc, SPREADSHEET_ID, [
+            column_range(SHEET_NAME, COL_INVOICE, START_ROW),
+            column_range(SHEET_NAME, COL_URL, START_ROW),
+            column_range(GIT_SHEET_NAME, GIT_COL_INVOICE, 2),
+        ]
+    ))
+    existing_git_invoices = set(v for v in git_invoices if v)
     print(f"Found {len(existing_git_invoices)} invoices already in GIT")
 
-    # read source columns
-    cols = sheet_get_columns(
-        sheets_svc, SPREADSHEET_ID, SHEET_NAME,
-        [(COL_INVOICE, START_ROW), (COL_URL, START_ROW)]
-    )
-    invoices = cols.get(COL_INVOICE, [])
-    urls = cols.get(COL_URL, [])
     rows_count = max(len(urls), len(invoices))
 
     # build pending list
@@ -287,64 +498,59 @@ def main():
 
     print(f"🟢 Processing {len(pending)} new invoice(s)")
 
-    for idx in pending:
-        row_num = START_ROW + idx
-        url = urls[idx].strip()
-        inv = invoices[idx].strip()
+    pending_rows, pending_public = [], []
+    # first successful row per invoice wins; later duplicates only act as fallbacks
+    recorded_invoices = set()
 
-        print(f"\nProcessing invoice {inv} from row {row_num}")
+    def flush(final=False):
+        set_files_public_anyone(drive_svc, pending_public)
+        flush_rows(sheets_svc, SPREADSHEET_ID, GIT_SHEET_NAME, GIT_COL_INVOICE, pending_rows, final)
 
-        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
-        tmp.close()
-
-        try:
-            # download
-            download_url_to_file(drive_svc, url, tmp.name, timeout=DOWNLOAD_TIMEOUT)
-
-            # compress
-            pdf_bytes, final_size, used_dpi, used_quality = iterative_render_and_compress(
-                tmp.name, TARGET_WIDTH_PT, TARGET_HEIGHT_PT
-            )
-
-            # upload
-            filename = safe_filename(inv)
-            file_id, uploaded_size = upload_file_to_drive_bytes(
-                drive_svc, pdf_bytes, filename, DEST_FOLDER_ID
-            )
-
-            set_file_public_anyone(drive_svc, file_id)
-
-            view_url = f"https://drive.google.com/uc?export=view&id={file_id}"
-            flag = "COMPRESSED" if uploaded_size <= MAX_TARGET_BYTES else "LARGE_FILE"
-
-            # next empty row in GIT
-            git_vals = sheets_svc.spreadsheets().values().get(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f"{GIT_SHEET_NAME}!A2:A{MAX_ROWS_TO_CHECK}"
-            ).execute().get("values", [])
-            git_next_row = len(git_vals) + 2
-
-            # write to GIT
-            sheet_update_cell(sheets_svc, SPREADSHEET_ID, GIT_SHEET_NAME,
-                              git_next_row, GIT_COL_INVOICE, inv)
-            sheet_update_cell(sheets_svc, SPREADSHEET_ID, GIT_SHEET_NAME,
-                              git_next_row, GIT_COL_URL, view_url)
-            sheet_update_cell(sheets_svc, SPREADSHEET_ID, GIT_SHEET_NAME,
-                              git_next_row, GIT_COL_LOG,
-                              f"{flag} dpi={used_dpi} q={used_quality} size={uploaded_size}")
-
-            print(f"✅ Added to GIT row {git_next_row}: {inv}")
-
-        except Exception as e:
-            print("❌ Error:", e)
-
-        finally:
+    cpu_pool = start_cpu_pool()
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+            futures = {
+                ex.submit(process_row, creds, cpu_pool, urls[idx].strip(), invoices[idx].strip(),
+                          START_ROW + idx): idx
+                for idx in pending
+            }
             try:
-                os.remove(tmp.name)
-            except Exception:
-                pass
+                for n, fut in enumerate(as_completed(futures), 1):
+                    inv = invoices[futures[fut]].strip()
+                    try:
+                        file_id, view_url, log = fut.result()
+                    except Exception as e:
+                        print(f"❌ Error ({inv}):", e)
+                        # persist what already succeeded before moving on
+                        flush()
+                    else:
+                        if inv in recorded_invoices:
+                            print(f"↩️ Duplicate row for {inv}, already recorded this run")
+                        else:
+                            recorded_invoices.add(inv)
+                            pending_public.append(file_id)
+                            pending_rows.append([inv, view_url, log])
+                            print(f"✅ Queued for GIT: {inv}")
+
+                    if n % FLUSH_EVERY_ROWS == 0:
+                        flush()
+            except BaseException:
+                # don't keep uploading rows whose results can no longer be recorded
+                ex.shutdown(wait=True, cancel_futures=True)
+                raise
+            finally:
+                flush(final=True)
+                # uploaded + shared but not in GIT: the next run would upload these again
+                for inv, view_url, _ in pending_rows:
+                    print(f"❌ Not recorded in GIT: {inv} → {view_url}")
+    finally:
+        cpu_pool.shutdown()
+
+    if pending_rows:
+        raise RuntimeError(f"{len(pending_rows)} uploaded invoice(s) could not be recorded in GIT")
 
     print("\n🎉 Finished all new invoices.")
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     main()